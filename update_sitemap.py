@@ -7,231 +7,541 @@ Usage:
     python3 update_sitemap.py --use-filesystem  # Use file modification dates instead of git
 """
 
+import functools
 import os
 import sys
-import xml.etree.ElementTree as ET
 import xml.sax.saxutils as saxutils
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
 import subprocess
 import argparse
 import tempfile
 import shutil
 
+try:
+    # lxml parses in C; ElementTree is the drop-in fallback
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+try:
+    # pygit2 reads git history in-process, without spawning git at all
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+# Probe for the git binary once instead of failing every git call
+HAS_GIT = shutil.which("git") is not None
+
 # Add project root to path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-# Route to template file mapping
-ROUTE_TO_FILE = {
-    "/": "templates/index.html"
-}
+# Sitemap location and namespace-qualified tag names
+SITEMAP_PATH = project_root / "seo" / "sitemap.xml"
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+URL_TAG = f"{{{SITEMAP_NS}}}url"
+LOC_TAG = f"{{{SITEMAP_NS}}}loc"
+LASTMOD_TAG = f"{{{SITEMAP_NS}}}lastmod"
+CHANGEFREQ_TAG = f"{{{SITEMAP_NS}}}changefreq"
+PRIORITY_TAG = f"{{{SITEMAP_NS}}}priority"
+
+# Values allowed in <changefreq> by the sitemap protocol
+CHANGEFREQ_VALUES = frozenset({"always", "hourly", "daily", "weekly", "monthly", "yearly", "never"})
+
+# Output templates for a single <url> entry (optional fields render as "")
+URL_TEMPLATE = '    <url>\n        <loc>{loc}</loc>\n{lastmod}{changefreq}{priority}    </url>\n'
+LASTMOD_TEMPLATE = '        <lastmod>{}</lastmod>\n'
+CHANGEFREQ_TEMPLATE = '        <changefreq>{}</changefreq>\n'
+PRIORITY_TEMPLATE = '        <priority>{}</priority>\n'
+
+
+class RouteConfig(NamedTuple):
+    """Sitemap settings for a single route."""
+    template: str
+    priority: Optional[float] = None
+    changefreq: Optional[str] = None
 
-# Priority mapping (can be customized)
-PRIORITY_MAP = {
-    "/": 1.0,
-    "/page_route": 0.9,
-    "/page_route": 0.8,
-}
 
-# Change frequency mapping
-CHANGEFREQ_MAP = {
-    "/": "weekly",
-    "/page_route": "weekly",
-    "/page_route": "daily",
-    "/page_route": "monthly",
-    "/page_route": "yearly",
+# Route to template file, priority and change frequency mapping (can be customized)
+ROUTE_CONFIG = {
+    "/": RouteConfig("templates/index.html", priority=1.0, changefreq="weekly"),
+    # "/page_route": RouteConfig("templates/page_route.html", priority=0.8, changefreq="monthly"),
 }
 
 
-def get_git_lastmod(file_path: Path) -> Tuple[Optional[str], Optional[bool]]:
+def get_git_head_blobs() -> Dict[str, str]:
     """
-    Get last modification date from git log.
+    List the files under project_root in HEAD with their blob ids, using git ls-tree.
     
     Returns:
-        tuple: (date_string, is_tracked) - date string and whether file is tracked in git
+        dict: paths relative to project_root mapped to blob ids
+    """
+    try:
+        # Run from project_root, ls-tree lists only its files, relative to it
+        result = subprocess.run(
+            ["git", "ls-tree", "-r", "-z", "HEAD"],
+            cwd=project_root,
+            capture_output=True,
+            check=True
+        )
+    except subprocess.CalledProcessError:
+        # Not a git repository (or no commits yet) - nothing is tracked
+        return {}
+    
+    head_blobs = {}
+    for entry in result.stdout.split(b"\0"):
+        if entry:
+            # Each entry is "<mode> <type> <id>\t<path>"
+            info, path = entry.split(b"\t", 1)
+            head_blobs[os.fsdecode(path)] = info.split()[2].decode("ascii")
+    return head_blobs
+
+
+def iter_git_log_changes():
+    """
+    Yield (date, changes) for every commit, newest first, from one git log walk.
+    
+    Each change is a (status, blob_id, path, ...) tuple as printed by --raw,
+    where blob_id is the file's content after the commit, e.g.
+    ("M", "3b18e5...", "templates/index.html") or ("R100", "3b18e5...", "old.html", "new.html").
+    Merge commits list the paths that differ from every parent, like --cc.
     """
     try:
-        # Get the most recent commit date for this file
+        # Combined diffs ignore --relative, so paths are made relative here instead
+        prefix = subprocess.run(
+            ["git", "rev-parse", "--show-prefix"],
+            cwd=project_root,
+            capture_output=True,
+            check=True
+        ).stdout.rstrip(b"\n")
+        # One pass over the whole history instead of one git call per file
         result = subprocess.run(
-            ["git", "log", "-1", "--format=%ci", "--", str(file_path)],
+            ["git", "log", "-z", "--raw", "--no-abbrev", "--cc", "-M", "--format=%x1e%ci"],
             cwd=project_root,
             capture_output=True,
-            text=True,
             check=True
         )
+    except subprocess.CalledProcessError:
+        # Not a git repository (or no commits yet) - nothing is tracked
+        return
+    
+    def relative(file_name):
+        return os.fsdecode(file_name[len(prefix):]) if file_name.startswith(prefix) else None
+    
+    # Each record is "<commit date>\0\n:<modes> <ids> <status>\0<path>\0...", newest
+    # commit first, with one leading colon per parent.
+    # With -z paths are printed verbatim (never C-quoted) and every field ends in
+    # NUL, so names containing tabs, quotes or newlines split correctly.
+    # Stay on bytes: dates are ASCII and only paths need decoding (git prints
+    # them as raw bytes, independent of the locale encoding text=True would use)
+    for record in result.stdout.split(b"\x1e")[1:]:
+        fields = record.split(b"\0")
+        # Parse git date format: "2025-11-12 10:30:45 +0300"
+        git_date = fields[0].split(None, 1)[0].decode("ascii")  # Get just the date part
+        fields = iter(fields[1:])
+        changes = []
+        for info in fields:
+            # The first entry follows the newline that ends the commit header
+            info = info.lstrip(b"\n")
+            if not info:
+                continue
+            is_merge = info.startswith(b"::")
+            *_, blob_id, status = info.decode("ascii").split()
+            # Renames and copies are followed by both the old and the new path
+            path_count = 2 if status[0] in "RC" and not is_merge else 1
+            paths = [relative(next(fields)) for _ in range(path_count)]
+            if path_count == 2 and all(paths):
+                changes.append((status, blob_id, *paths))
+            elif paths[-1]:
+                # Added, modified, or moved into project_root
+                changes.append(("A" if path_count == 2 else status, blob_id, paths[-1]))
+        yield git_date, changes
+
+
+def open_pygit2_repository():
+    """
+    Open the repository containing project_root with pygit2.
+    
+    Returns:
+        tuple: (repo, prefix) - the repository, or None if nothing is tracked,
+        and the path of project_root inside it ("" or ending in "/")
+    """
+    repo_path = pygit2.discover_repository(str(project_root))
+    if repo_path is None:
+        return None, ""
+    repo = pygit2.Repository(repo_path)
+    if repo.workdir is None or repo.head_is_unborn:
+        # Bare repository or no commits yet - nothing is tracked
+        return None, ""
+    
+    # Repository paths are relative to its root, ours to project_root
+    prefix = project_root.resolve().relative_to(Path(repo.workdir).resolve()).as_posix()
+    return repo, "" if prefix == "." else prefix + "/"
+
+
+def get_pygit2_head_blobs() -> Dict[str, str]:
+    """
+    List the files under project_root in HEAD with their blob ids, using pygit2.
+    
+    Returns:
+        dict: paths relative to project_root mapped to blob ids
+    """
+    repo, prefix = open_pygit2_repository()
+    if repo is None:
+        return {}
+    tree = repo.head.peel(pygit2.Commit).tree
+    if prefix:
+        try:
+            tree = tree[prefix.rstrip("/")]
+        except KeyError:
+            return {}
+        if not isinstance(tree, pygit2.Tree):
+            return {}
+    
+    head_blobs = {}
+    
+    def collect(tree, base):
+        for entry in tree:
+            if entry.type_str == "tree":
+                collect(entry, f"{base}{entry.name}/")
+            else:
+                head_blobs[base + entry.name] = str(entry.id)
+    
+    collect(tree, "")
+    return head_blobs
+
+
+def iter_pygit2_changes():
+    """
+    Yield (date, changes) for every commit, newest first, using pygit2.
+    
+    Changes use the same (status, blob_id, path, ...) format as iter_git_log_changes().
+    """
+    repo, prefix = open_pygit2_repository()
+    if repo is None:
+        return
+    
+    def relative(file_name):
+        return file_name[len(prefix):] if file_name.startswith(prefix) else None
+    
+    for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TIME):
+        # Committer date in the committer's timezone, same as git's %ci
+        commit_tz = timezone(timedelta(minutes=commit.commit_time_offset))
+        git_date = datetime.fromtimestamp(commit.commit_time, commit_tz).strftime("%Y-%m-%d")
         
-        if result.stdout.strip():
-            # Parse git date format: "2025-11-12 10:30:45 +0300"
-            git_date = result.stdout.strip().split()[0]  # Get just the date part
-            return git_date, True
+        if len(commit.parents) > 1:
+            # Like git log --cc, a merge changes the paths that differ from every parent
+            diffs = [parent.tree.diff_to_tree(commit.tree) for parent in commit.parents]
+            merged = set.intersection(*({delta.new_file.path for delta in diff.deltas} for diff in diffs))
+            yield git_date, [("M", str(delta.new_file.id), relative(delta.new_file.path)) for delta in diffs[0].deltas
+                             if delta.new_file.path in merged and relative(delta.new_file.path)]
+            continue
+        
+        if commit.parents:
+            diff = commit.parents[0].tree.diff_to_tree(commit.tree)
         else:
-            # File not in git
-            return None, False
-    except subprocess.CalledProcessError:
-        # File not tracked in git
-        return None, False
-    except FileNotFoundError:
+            diff = commit.tree.diff_to_tree(swap=True)
+        diff.find_similar(flags=pygit2.GIT_DIFF_FIND_RENAMES)
+        
+        changes = []
+        for delta in diff.deltas:
+            old_path = relative(delta.old_file.path)
+            new_path = relative(delta.new_file.path)
+            blob_id = str(delta.new_file.id)
+            if delta.status == pygit2.GIT_DELTA_RENAMED and old_path and new_path:
+                changes.append((f"R{delta.similarity:03d}", blob_id, old_path, new_path))
+            elif delta.status in (pygit2.GIT_DELTA_DELETED, pygit2.GIT_DELTA_RENAMED) and old_path:
+                # Deleted, or moved out of project_root
+                changes.append(("D", blob_id, old_path))
+            elif new_path:
+                # Added, modified, or moved into project_root
+                changes.append(("A" if delta.status == pygit2.GIT_DELTA_RENAMED else delta.status_char(), blob_id, new_path))
+        yield git_date, changes
+
+
+def get_git_lastmod_index() -> Dict[str, str]:
+    """
+    Collect last commit dates for files present in HEAD from a single history walk.
+    
+    A commit only counts for a file if it left the file's content as it is in
+    HEAD. This skips changes a merge threw away (e.g. a branch merged with
+    -s ours), which git log -- <file> leaves out by history simplification.
+    Pure renames (100% similarity) don't count as modifications: the renamed
+    file inherits the date of the last content change under its old name.
+    
+    Returns:
+        dict: paths relative to project_root mapped to date strings
+    """
+    if pygit2 is not None:
+        head_blobs, history = get_pygit2_head_blobs(), iter_pygit2_changes()
+    else:
+        head_blobs, history = get_git_head_blobs(), iter_git_log_changes()
+    
+    lastmod_index = {}  # path in HEAD -> date
+    pending = {file_name: [file_name] for file_name in head_blobs}  # path in history -> HEAD paths still to date there
+    rename_dates = {}  # path in HEAD -> date of its pure rename (used if nothing older is found)
+    
+    for git_date, changes in history:
+        for status, blob_id, *paths in changes:
+            heirs = pending.get(paths[-1])
+            if not heirs:
+                continue
+            found = [heir for heir in heirs if head_blobs[heir] == blob_id]
+            if not found:
+                # Content that didn't make it into HEAD
+                continue
+            heirs[:] = [heir for heir in heirs if head_blobs[heir] != blob_id]
+            if not heirs:
+                del pending[paths[-1]]
+            if status == "R100":
+                # Content unchanged - follow the file back to its old name
+                for heir in found:
+                    rename_dates.setdefault(heir, git_date)
+                pending.setdefault(paths[0], []).extend(found)
+            else:
+                # Newest commit wins, also for files that were later renamed from this path
+                for heir in found:
+                    lastmod_index[heir] = git_date
+        if not pending:
+            break
+    
+    # Renamed files whose old name has no earlier history keep the rename date
+    for file_name, git_date in rename_dates.items():
+        lastmod_index.setdefault(file_name, git_date)
+    return lastmod_index
+
+
+def get_git_lastmod(file_path: Path, git_index: Optional[Dict[str, str]]) -> Tuple[Optional[str], Optional[bool]]:
+    """
+    Get last modification date from the git history index.
+    
+    Returns:
+        tuple: (date_string, is_tracked) - date string and whether file is tracked in git
+    """
+    if git_index is None:
         # Git not available
         return None, None
+    
+    git_date = git_index.get(file_path.relative_to(project_root).as_posix())
+    if git_date is None:
+        # File not tracked in git (or deleted from HEAD)
+        return None, False
+    return git_date, True
 
 
+@functools.lru_cache(maxsize=None)
 def get_file_lastmod(file_path: Path) -> str:
-    """Get last modification date from file system."""
+    """Get last modification date from file system (cached per run)."""
     try:
-        if file_path.exists():
-            mtime = os.path.getmtime(file_path)
-            return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d")
-        else:
-            return datetime.now().strftime("%Y-%m-%d")
+        # A single stat() both checks existence and reads the mtime
+        mtime = file_path.stat().st_mtime
     except OSError:
+        # Missing or unreadable file
         return datetime.now().strftime("%Y-%m-%d")
+    return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d")
 
 
-def update_sitemap(use_filesystem: bool = False):
-    """Update sitemap.xml with current lastmod dates."""
-    sitemap_path = project_root / "seo" / "sitemap.xml"
+def iter_sitemap_urls(sitemap_path: Path):
+    """
+    Yield <url> elements one at a time while parsing the sitemap incrementally.
     
-    if not sitemap_path.exists():
-        print(f"❌ Error: sitemap.xml not found at {sitemap_path}")
-        sys.exit(1)
+    Each element is cleared and detached once the caller is done with it,
+    so memory use stays flat regardless of sitemap size.
+    """
+    context = ET.iterparse(str(sitemap_path), events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == URL_TAG:
+            yield elem
+            elem.clear()
+            root.remove(elem)
+
+
+def escaped_text(elem) -> Optional[str]:
+    """XML-escaped text of an element taken over from the existing sitemap."""
+    if elem is None or not elem.text:
+        return None
+    return saxutils.escape(elem.text)
+
+
+def validate_route_config():
+    """Make sure ROUTE_CONFIG values can be written to XML without escaping."""
+    for path, route in ROUTE_CONFIG.items():
+        if route.changefreq is not None and route.changefreq not in CHANGEFREQ_VALUES:
+            raise ValueError(f"Invalid changefreq for {path}: {route.changefreq!r}")
+        if route.priority is not None and not 0.0 <= float(route.priority) <= 1.0:
+            raise ValueError(f"Invalid priority for {path}: {route.priority!r} (must be 0.0-1.0)")
+
+
+def format_url(loc: str, lastmod: Optional[str], changefreq: Optional[str], priority: Optional[str]) -> str:
+    """
+    Serialize a single <url> entry.
     
-    # Parse existing sitemap
-    tree = ET.parse(sitemap_path)
-    root = tree.getroot()
+    Only loc is escaped here; the other values must already be XML-safe
+    (generated dates, validated ROUTE_CONFIG values or escaped_text()).
+    """
+    return URL_TEMPLATE.format(
+        loc=saxutils.escape(loc),
+        lastmod=LASTMOD_TEMPLATE.format(lastmod) if lastmod else "",
+        changefreq=CHANGEFREQ_TEMPLATE.format(changefreq) if changefreq else "",
+        priority=PRIORITY_TEMPLATE.format(priority) if priority else "",
+    )
+
+
+def update_url(url_elem, use_filesystem: bool, git_index: Optional[Dict[str, str]],
+               log_lines: list) -> Tuple[int, str]:
+    """
+    Compute the updated lastmod/changefreq/priority for a <url> element and serialize it.
+    
+    url_elem itself is left unmodified; the new values only end up in the returned XML.
+    
+    Returns:
+        tuple: (updated_count, xml) - number of modified fields and the serialized entry
+    """
+    loc_elem = url_elem.find(LOC_TAG)
+    if loc_elem is None:
+        return 0, ""
+    lastmod_elem = url_elem.find(LASTMOD_TAG)
+    changefreq_elem = url_elem.find(CHANGEFREQ_TAG)
+    priority_elem = url_elem.find(PRIORITY_TAG)
     
-    # Namespace
-    ns = {"sitemap": "http://www.sitemaps.org/schemas/sitemap/0.9"}
+    url_path = loc_elem.text.strip()
+    # Extract path from full URL (one scan, no intermediate list)
+    _, domain, path = url_path.partition("yourdomainname.com")
+    path = path or "/"
+    route = ROUTE_CONFIG.get(path) if domain else None
+    if route is None:
+        if domain:
+            log_lines.append(f"⚠️  Warning: No template mapping for {path}, skipping...")
+        # Keep the entry as it is
+        return 0, format_url(loc_elem.text, escaped_text(lastmod_elem),
+                             escaped_text(changefreq_elem), escaped_text(priority_elem))
     
+    template_file = route.template
+    template_path = project_root / template_file
     updated_count = 0
     
-    # Update each URL entry
-    for url_elem in root.findall("sitemap:url", ns):
-        loc_elem = url_elem.find("sitemap:loc", ns)
-        if loc_elem is None:
-            continue
-        
-        url_path = loc_elem.text.strip()
-        # Extract path from full URL
-        if "yourdomainname.com" in url_path:
-            path = url_path.split("yourdomainname.com")[1] or "/"
-        else:
-            continue
-        
-        # Get corresponding template file
-        template_file = ROUTE_TO_FILE.get(path)
-        if not template_file:
-            print(f"⚠️  Warning: No template mapping for {path}, skipping...")
-            continue
-        
-        template_path = project_root / template_file
-        
-        # Get last modification date
-        if use_filesystem:
-            lastmod_date = get_file_lastmod(template_path)
-            source = "filesystem"
-            is_tracked = None
-        else:
-            lastmod_date, is_tracked = get_git_lastmod(template_path)
-            if lastmod_date is None:
-                if is_tracked is False:
-                    # File not tracked in git - warn and use filesystem
-                    print(f"⚠️  Warning: {template_file} not tracked in git, using filesystem date")
-                    lastmod_date = get_file_lastmod(template_path)
-                    source = "filesystem (not in git)"
-                elif is_tracked is None:
-                    # Git not available - fallback to filesystem
-                    lastmod_date = get_file_lastmod(template_path)
-                    source = "filesystem (git unavailable)"
-                else:
-                    lastmod_date = get_file_lastmod(template_path)
-                    source = "filesystem"
-            else:
-                source = "git"
-        
-        # Update lastmod element
-        lastmod_elem = url_elem.find("sitemap:lastmod", ns)
-        if lastmod_elem is not None:
-            old_date = lastmod_elem.text
-            lastmod_elem.text = lastmod_date
-            if old_date != lastmod_date:
-                print(f"✅ Updated {path}: {old_date} → {lastmod_date} ({source})")
-                updated_count += 1
+    # Get last modification date
+    if use_filesystem:
+        lastmod_date = get_file_lastmod(template_path)
+        source = "filesystem"
+        is_tracked = None
+    else:
+        lastmod_date, is_tracked = get_git_lastmod(template_path, git_index)
+        if lastmod_date is None:
+            if is_tracked is False:
+                # File not tracked in git - warn and use filesystem
+                log_lines.append(f"⚠️  Warning: {template_file} not tracked in git, using filesystem date")
+                lastmod_date = get_file_lastmod(template_path)
+                source = "filesystem (not in git)"
+            elif is_tracked is None:
+                # Git not available - fallback to filesystem
+                lastmod_date = get_file_lastmod(template_path)
+                source = "filesystem (git unavailable)"
             else:
-                print(f"ℹ️  {path}: already up to date ({lastmod_date})")
+                lastmod_date = get_file_lastmod(template_path)
+                source = "filesystem"
         else:
-            # Create lastmod element if it doesn't exist (with namespace)
-            lastmod_elem = ET.SubElement(url_elem, "{http://www.sitemaps.org/schemas/sitemap/0.9}lastmod")
-            lastmod_elem.text = lastmod_date
-            print(f"✅ Added lastmod for {path}: {lastmod_date} ({source})")
+            source = "git"
+    
+    # Update lastmod
+    if lastmod_elem is not None:
+        old_date = lastmod_elem.text
+        if old_date != lastmod_date:
+            log_lines.append(f"✅ Updated {path}: {old_date} → {lastmod_date} ({source})")
             updated_count += 1
-        
-        # Ensure priority and changefreq are set correctly
-        priority_elem = url_elem.find("sitemap:priority", ns)
-        if priority_elem is None and path in PRIORITY_MAP:
-            # Create priority element if it doesn't exist
-            priority_elem = ET.SubElement(url_elem, "{http://www.sitemaps.org/schemas/sitemap/0.9}priority")
-            priority_elem.text = str(PRIORITY_MAP[path])
+        else:
+            log_lines.append(f"ℹ️  {path}: already up to date ({lastmod_date})")
+    else:
+        log_lines.append(f"✅ Added lastmod for {path}: {lastmod_date} ({source})")
+        updated_count += 1
+    
+    # Ensure changefreq and priority are set correctly
+    if route.changefreq is not None:
+        changefreq = route.changefreq
+        if changefreq_elem is None or changefreq_elem.text != changefreq:
             updated_count += 1
-        elif priority_elem is not None and path in PRIORITY_MAP:
-            priority_elem.text = str(PRIORITY_MAP[path])
-        
-        changefreq_elem = url_elem.find("sitemap:changefreq", ns)
-        if changefreq_elem is None and path in CHANGEFREQ_MAP:
-            # Create changefreq element if it doesn't exist
-            changefreq_elem = ET.SubElement(url_elem, "{http://www.sitemaps.org/schemas/sitemap/0.9}changefreq")
-            changefreq_elem.text = CHANGEFREQ_MAP[path]
+    else:
+        changefreq = escaped_text(changefreq_elem)
+    
+    if route.priority is not None:
+        priority = str(route.priority)
+        if priority_elem is None or priority_elem.text != priority:
             updated_count += 1
-        elif changefreq_elem is not None and path in CHANGEFREQ_MAP:
-            changefreq_elem.text = CHANGEFREQ_MAP[path]
-    
-    # Write updated sitemap to temporary file first (atomic write)
-    with tempfile.NamedTemporaryFile(
-        mode='w',
-        encoding='utf-8',
-        delete=False,
-        suffix='.xml',
-        dir=sitemap_path.parent
-    ) as tmpfile:
-        tmp_path = Path(tmpfile.name)
-        
-        # Write XML with proper escaping
-        tmpfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        tmpfile.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
-        
-        for url_elem in root.findall("sitemap:url", ns):
-            loc_elem = url_elem.find("sitemap:loc", ns)
-            lastmod_elem = url_elem.find("sitemap:lastmod", ns)
-            changefreq_elem = url_elem.find("sitemap:changefreq", ns)
-            priority_elem = url_elem.find("sitemap:priority", ns)
-            
-            if loc_elem is None:
-                continue
-            
-            # XML escape all text content (though ElementTree should handle this, we're being explicit)
-            loc_text = saxutils.escape(loc_elem.text) if loc_elem.text else ""
-            lastmod_text = saxutils.escape(lastmod_elem.text) if lastmod_elem is not None and lastmod_elem.text else None
-            changefreq_text = saxutils.escape(changefreq_elem.text) if changefreq_elem is not None and changefreq_elem.text else None
-            priority_text = saxutils.escape(priority_elem.text) if priority_elem is not None and priority_elem.text else None
-            
-            tmpfile.write('    <url>\n')
-            tmpfile.write(f'        <loc>{loc_text}</loc>\n')
-            if lastmod_text:
-                tmpfile.write(f'        <lastmod>{lastmod_text}</lastmod>\n')
-            if changefreq_text:
-                tmpfile.write(f'        <changefreq>{changefreq_text}</changefreq>\n')
-            if priority_text:
-                tmpfile.write(f'        <priority>{priority_text}</priority>\n')
-            tmpfile.write('    </url>\n')
-        
-        tmpfile.write('</urlset>\n')
+    else:
+        priority = escaped_text(priority_elem)
+    
+    # Dates and validated ROUTE_CONFIG values never need XML escaping
+    return updated_count, format_url(loc_elem.text, lastmod_date, changefreq, priority)
+
+
+def update_sitemap(use_filesystem: bool = False):
+    """Update sitemap.xml with current lastmod dates."""
+    if not SITEMAP_PATH.exists():
+        print(f"❌ Error: sitemap.xml not found at {SITEMAP_PATH}")
+        sys.exit(1)
+    
+    validate_route_config()
+    
+    # Drop file dates cached by a previous run in the same process
+    get_file_lastmod.cache_clear()
+    
+    # Read commit dates for all files up front
+    git_index = None
+    if not use_filesystem:
+        if pygit2 is None and not HAS_GIT:
+            print("⚠️  Warning: git not found, using filesystem dates\n")
+        else:
+            git_index = get_git_lastmod_index()
+    
+    updated_count = 0
+    log_lines = []
+    tmp_path = None
+    
+    try:
+        # Stream the updated sitemap into a temporary file first (atomic write):
+        # each <url> is written and freed as soon as it has been updated
+        with tempfile.NamedTemporaryFile(
+            mode='w',
+            encoding='utf-8',
+            delete=False,
+            suffix='.xml',
+            dir=SITEMAP_PATH.parent
+        ) as tmpfile:
+            tmp_path = Path(tmpfile.name)
+            tmpfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            tmpfile.write(f'<urlset xmlns="{SITEMAP_NS}">\n')
+            for url_elem in iter_sitemap_urls(SITEMAP_PATH):
+                url_updates, url_xml = update_url(url_elem, use_filesystem, git_index, log_lines)
+                updated_count += url_updates
+                tmpfile.write(url_xml)
+            tmpfile.write('</urlset>\n')
+    except Exception:
+        # Clean up temp file on error
+        if tmp_path is not None and tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    finally:
+        # Emit the per-URL log in one write instead of a locked print() per line
+        # (also on errors, so the URLs handled so far are still reported)
+        if log_lines:
+            sys.stdout.write("\n".join(log_lines) + "\n")
+    
+    if updated_count == 0:
+        # Nothing changed - drop the copy and leave sitemap.xml (and its mtime) untouched
+        tmp_path.unlink()
+        print("\nℹ️  Sitemap already up to date, skipping write")
+        print(f"📄 Location: {SITEMAP_PATH}")
+        return
     
     # Atomically replace the original file
     try:
-        shutil.move(str(tmp_path), str(sitemap_path))
+        # Temp file lives next to sitemap.xml, so this is a single atomic rename
+        os.replace(tmp_path, SITEMAP_PATH)
         print(f"\n✅ Sitemap updated successfully! ({updated_count} entries modified)")
-        print(f"📄 Location: {sitemap_path}")
+        print(f"📄 Location: {SITEMAP_PATH}")
     except Exception as e:
         # Clean up temp file on error
         if tmp_path.exists():